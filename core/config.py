@@ -1,7 +1,10 @@
 # core/config.py
 import sqlite3
+import threading
 from pathlib import Path
 
+from .db import PRAGMAS
+
 DEFAULTS = {
     "max_retries": "3",
     "backoff_base": "2",
@@ -12,15 +15,18 @@ DEFAULTS = {
 class ConfigStore:
     def __init__(self, db_path: str):
         self.db_path = db_path
+        self._local = threading.local()
         Path(db_path).parent.mkdir(parents=True, exist_ok=True)
         self._ensure_table()
-        for k, v in DEFAULTS.items():
-            if self.get(k) is None:
-                self.set(k, v)
 
     def _conn(self):
-        conn = sqlite3.connect(self.db_path, timeout=30)
-        conn.row_factory = sqlite3.Row
+        # One long-lived connection per thread.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, cached_statements=256)
+            conn.row_factory = sqlite3.Row
+            conn.executescript(PRAGMAS)
+            self._local.conn = conn
         return conn
 
     def _ensure_table(self):
@@ -31,6 +37,7 @@ class ConfigStore:
                 value TEXT NOT NULL
             );
             """)
+            c.executemany("INSERT OR IGNORE INTO config(key,value) VALUES(?,?)", list(DEFAULTS.items()))
 
     def set(self, key: str, value: str):
         with self._conn() as c:
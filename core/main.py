@@ -1,12 +1,18 @@
 # core/main.py
+import contextlib
+import io
+import itertools
 import json
 import os
+import shlex
 import signal
+import sqlite3
 import sys
+import traceback
 import time
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
-from tabulate import tabulate
 import click
 
 
@@ -15,17 +21,64 @@ ROOT = CURRENT_DIR.parent
 DATA_DIR = ROOT / "data"
 LOGS_DIR = DATA_DIR / "logs"
 DB_PATH = str(DATA_DIR / "queuectl.db")
+ENQUEUE_BATCH = 10_000
+JOB_STATES = ["pending", "processing", "completed", "failed", "dead"]
+QUERY_OPS = ("status", "list", "dlq_list")
+# What a well-formed job can still fail with in the store: bad field values
+# (ValueError/TypeError) or an id that is already taken (IntegrityError).
+JOB_ERRORS = (ValueError, TypeError, sqlite3.IntegrityError)
 
 
 from .db import JobStore
 from .worker import WorkerManager
 from .config import ConfigStore
-from .web import dashboard_app
 
 
-store = JobStore(DB_PATH, LOGS_DIR)
-config = ConfigStore(DB_PATH)
-manager = WorkerManager(store, config)
+def tabulate(rows, **kwargs):
+    # Imported lazily: the default list output never needs it.
+    from tabulate import tabulate as _tabulate
+    return _tabulate(rows, **kwargs)
+
+
+# TSV escaping, as in PostgreSQL's text COPY format: a value can never spill
+# into the next field or row.
+TSV_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def print_rows(rows, fmt):
+    """Print job dicts; tsv and json stream one row at a time. False if empty."""
+    first = next(rows, None)
+    if first is None:
+        return False
+    rows = itertools.chain([first], rows)
+    if fmt == "pretty":
+        click.echo(tabulate(rows, headers="keys"))
+        return True
+    out = sys.stdout
+    if fmt == "json":
+        for r in rows:
+            out.write(json.dumps(r) + "\n")
+    else:
+        out.write("\t".join(first) + "\n")
+        for r in rows:
+            out.write("\t".join("" if v is None else str(v).translate(TSV_ESCAPES) for v in r.values()) + "\n")
+    out.flush()
+    return True
+
+
+# Opened on first use rather than at import: spawned workers re-import this
+# module via __main__ and open their own stores in WorkerProcess.run.
+@lru_cache(maxsize=None)
+def get_store():
+    return JobStore(DB_PATH, LOGS_DIR)
+
+@lru_cache(maxsize=None)
+def get_config():
+    return ConfigStore(DB_PATH)
+
+@lru_cache(maxsize=None)
+def get_manager():
+    return WorkerManager(get_store(), get_config())
 
 @click.group(help="queuectl - CLI background job queue")
 def cli():
@@ -43,6 +96,9 @@ def enqueue(job_json, priority, run_at, timeout, max_retries):
         job = json.loads(job_json)
     except Exception as e:
         click.echo(f"Invalid JSON: {e}", err=True); sys.exit(2)
+    problem = job_problem(job)
+    if problem:
+        click.echo(f"Invalid job: {problem}", err=True); sys.exit(2)
     if priority is not None:
         job["priority"] = priority
     if run_at:
@@ -51,10 +107,78 @@ def enqueue(job_json, priority, run_at, timeout, max_retries):
         job["timeout_secs"] = timeout
     if max_retries is not None:
         job["max_retries"] = max_retries
-    created = store.enqueue(job)
+    try:
+        created = get_store().enqueue(job)
+    except sqlite3.IntegrityError:
+        click.echo(f"Invalid job: id {job['id']!r} already exists", err=True); sys.exit(2)
+    except JOB_ERRORS as e:
+        click.echo(f"Invalid job: {e}", err=True); sys.exit(2)
     click.echo(tabulate([created], headers="keys"))
 
 
+def job_problem(job):
+    """Why job can't be enqueued at all, or None."""
+    if not isinstance(job, dict):
+        return "expected a JSON object"
+    missing = [key for key in ("id", "command") if key not in job]
+    if missing:
+        return "missing " + ", ".join(f'"{key}"' for key in missing)
+    return None
+
+
+def taken_ids(batch):
+    """Ids in batch that already exist or repeat within it."""
+    ids = [job["id"] for job in batch]
+    seen, taken = set(), set()
+    for job_id in ids:
+        (taken if job_id in seen else seen).add(job_id)
+    taken.update(job_id for job_id, state in get_store().states(seen).items() if state)
+    return sorted(taken, key=str)
+
+
+@cli.command("enqueue-file", help="Enqueue jobs from a JSON-lines file (one job per line, '-' for stdin)")
+@click.argument("jobs_file", type=click.File("r"))
+def enqueue_file(jobs_file):
+    # Each batch of ENQUEUE_BATCH jobs is its own transaction, so on an error
+    # the batches before it stay enqueued; say how many.
+    batch, total, first_line = [], 0, None
+
+    def fail(message):
+        click.echo(message, err=True)
+        click.echo(f"Enqueued {total} job(s) before the error", err=True)
+        sys.exit(2)
+
+    def flush(last_line):
+        where = f"line {first_line}" if first_line == last_line else f"lines {first_line}-{last_line}"
+        try:
+            return len(get_store().enqueue_many(batch))
+        except sqlite3.IntegrityError:
+            fail(f"Invalid job on {where}: id already exists: "
+                 + ", ".join(map(repr, taken_ids(batch))))
+        except JOB_ERRORS as e:
+            fail(f"Invalid job on {where}: {e}")
+
+    for lineno, line in enumerate(jobs_file, 1):
+        if not line.strip():
+            continue
+        try:
+            job = json.loads(line)
+        except Exception as e:
+            fail(f"Invalid JSON on line {lineno}: {e}")
+        problem = job_problem(job)
+        if problem:
+            fail(f"Invalid job on line {lineno}: {problem}")
+        if not batch:
+            first_line = lineno
+        batch.append(job)
+        if len(batch) >= ENQUEUE_BATCH:
+            total += flush(lineno)
+            batch = []
+    if batch:
+        total += flush(lineno)
+    click.echo(f"Enqueued {total} job(s)")
+
+
 @cli.group(help="Worker management")
 def worker():
     pass
@@ -62,6 +186,7 @@ def worker():
 @worker.command("start", help="Start N workers (foreground). Ctrl+C to stop.")
 @click.option("--count", default=1, show_default=True, type=int)
 def worker_start(count):
+    manager = get_manager()
     click.echo(f"Starting {count} worker(s)...")
 
     def handle(_sig, _frm):
@@ -80,38 +205,117 @@ def worker_start(count):
 
 @worker.command("stop", help="Gracefully stop workers (if running in this process)")
 def worker_stop():
-    manager.stop()
+    get_manager().stop()
     click.echo("Stop requested")
 
 
-@cli.command(help="Show summary of all job states & metrics")
-def status():
+@cli.command(help="Show summary of all job states & metrics (and the state of any JOB_IDS given)")
+@click.argument("job_ids", nargs=-1)
+@click.option("--json", "as_json", is_flag=True, help="Print as a single JSON object")
+def status(job_ids, as_json):
+    store = get_store()
     s = store.stats()
+    states = store.states(job_ids) if job_ids else None
+    if as_json:
+        if states is not None:
+            s["jobs"] = states
+        click.echo(json.dumps(s))
+        return
     click.echo(tabulate([s], headers="keys"))
+    if states is not None:
+        click.echo()
+        click.echo(tabulate(list(states.items()), headers=["id", "state"]))
 
 @cli.command("list", help="List jobs (optionally filter by --state)")
-@click.option("--state", type=click.Choice(["pending","processing","completed","failed","dead"]), default=None)
-def list_cmd(state):
-    jobs = store.list(state)
-    if jobs:
-        click.echo(tabulate(jobs, headers="keys"))
-    else:
+@click.option("--state", type=click.Choice(JOB_STATES), default=None)
+@click.option("--limit", type=int, default=None, help="Show at most N jobs")
+@click.option("--offset", type=int, default=0, show_default=True, help="Skip the first N jobs")
+@click.option("--tsv", "fmt", flag_value="tsv", default=True, help="Tab-separated rows (default)")
+@click.option("--json", "fmt", flag_value="json", help="One JSON object per line")
+@click.option("--pretty", "fmt", flag_value="pretty", help="Aligned table (buffers every row)")
+def list_cmd(state, limit, offset, fmt):
+    if not print_rows(get_store().list(state, limit=limit, offset=offset), fmt):
         click.echo("No jobs found.")
 
 
+def valid_query_spec(spec):
+    if not isinstance(spec, dict) or spec.get("op") not in QUERY_OPS:
+        return False
+    jobs = spec.get("jobs")
+    if jobs is not None and not (isinstance(jobs, list) and all(isinstance(j, str) for j in jobs)):
+        return False
+    return spec.get("state") is None or spec["state"] in JOB_STATES
+
+
+def answer_queries(specs):
+    """Answer status/list/dlq_list specs with one stats query and at most one
+    pass over the jobs table, however many specs there are.
+
+    Rows come back in the same order as `list` and `list --state`.
+    """
+    store = get_store()
+    jobs, by_state = [], {}
+    if any(spec["op"] in ("list", "dlq_list") for spec in specs):
+        for r in store.list():
+            jobs.append(r)
+            by_state.setdefault(r["state"], []).append(r)
+        # The walk is in created_at order; a stable sort on priority gives
+        # LIST_STATE_SQL's (priority, created_at) order within each state.
+        for bucket in by_state.values():
+            bucket.sort(key=lambda r: r["priority"])
+    stats = store.stats() if any(spec["op"] == "status" for spec in specs) else None
+    results = []
+    for spec in specs:
+        op = spec["op"]
+        if op == "status":
+            res = dict(stats)
+            if spec.get("jobs"):
+                res["jobs"] = store.states(spec["jobs"])
+        elif op == "dlq_list":
+            res = by_state.get("dead", [])
+        elif spec.get("state"):
+            res = by_state.get(spec["state"], [])
+        else:
+            res = jobs
+        results.append(res)
+    return results
+
+
+@cli.command(help="Answer a JSON query spec, e.g. '{\"op\":\"list\",\"state\":\"pending\"}' (ops: status, list, dlq_list)")
+@click.argument("spec_json")
+@click.option("--multi", is_flag=True, help="SPEC_JSON is a list of specs; print a list of results")
+def query(spec_json, multi):
+    try:
+        specs = json.loads(spec_json)
+    except Exception as e:
+        click.echo(f"Invalid JSON: {e}", err=True); sys.exit(2)
+    if not multi:
+        specs = [specs]
+    elif not isinstance(specs, list):
+        click.echo("Invalid query: --multi expects a JSON list of specs", err=True); sys.exit(2)
+    for spec in specs:
+        if not valid_query_spec(spec):
+            click.echo(f"Invalid query spec: {json.dumps(spec)}", err=True); sys.exit(2)
+    results = answer_queries(specs)
+    click.echo(json.dumps(results if multi else results[0]))
+
+
 @cli.group(help="Dead Letter Queue operations")
 def dlq():
     pass
 
 @dlq.command("list", help="List DLQ jobs")
-def dlq_list():
-    jobs = store.list("dead")
-    click.echo(tabulate(jobs, headers="keys") if jobs else "DLQ empty.")
+@click.option("--tsv", "fmt", flag_value="tsv", default=True, help="Tab-separated rows (default)")
+@click.option("--json", "fmt", flag_value="json", help="One JSON object per line")
+@click.option("--pretty", "fmt", flag_value="pretty", help="Aligned table (buffers every row)")
+def dlq_list(fmt):
+    if not print_rows(get_store().list("dead"), fmt):
+        click.echo("DLQ empty.")
 
 @dlq.command("retry", help="Retry a DLQ job (moves back to pending, resets attempts)")
 @click.argument("job_id")
 def dlq_retry(job_id):
-    store.retry_from_dlq(job_id)
+    get_store().retry_from_dlq(job_id)
     click.echo(f"Retry requested for {job_id}")
 
 
@@ -123,23 +327,64 @@ def config_cmd():
 @click.argument("key")
 @click.argument("value")
 def config_set(key, value):
-    config.set(key, value)
+    get_config().set(key, value)
     click.echo(f"Set {key} = {value}")
 
 @config_cmd.command("get", help="Get a config key")
 @click.argument("key")
 def config_get(key):
-    click.echo(config.get(key))
+    click.echo(get_config().get(key))
 
 @config_cmd.command("show", help="Show all config")
 def config_show():
-    click.echo(tabulate([config.all()], headers="keys"))
+    click.echo(tabulate([get_config().all()], headers="keys"))
+
+
+def dispatch(argv):
+    """Run one queuectl command in this process and return its exit code."""
+    try:
+        cli.main(args=list(argv), prog_name="queuectl")
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(e.code, file=sys.stderr)
+        return 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+@cli.command(help="Read commands from stdin, one per line, and answer each with a JSON line")
+def repl():
+    # Every command shares this process's store and config connections, so
+    # callers pay interpreter start-up and imports once rather than per command.
+    # Commands see an empty stdin; the real one carries the command stream.
+    commands, reply = sys.stdin, sys.stdout
+    for line in commands:
+        try:
+            argv = shlex.split(line)
+        except ValueError as e:
+            reply.write(json.dumps({"exit": 2, "stdout": "", "stderr": f"Invalid command line: {e}\n"}) + "\n")
+            reply.flush()
+            continue
+        if not argv:
+            continue
+        out, err = io.StringIO(), io.StringIO()
+        sys.stdin = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+                code = dispatch(argv)
+        finally:
+            sys.stdin = commands
+        reply.write(json.dumps({"exit": code, "stdout": out.getvalue(), "stderr": err.getvalue()}) + "\n")
+        reply.flush()
 
 
 @cli.command(help="Show paths to logs for a job")
 @click.argument("job_id")
 def logs(job_id):
-    out, err = store.log_paths_for(job_id)
+    out, err = get_store().log_paths_for(job_id)
     click.echo(f"stdout: {out}\nstderr: {err}")
 
 
@@ -148,7 +393,8 @@ def logs(job_id):
 @click.option("--port", default=8000, show_default=True, type=int)
 def web(host, port):
     import uvicorn
-    app = dashboard_app(DB_PATH, LOGS_DIR)
+    from .web import dashboard_app
+    app = dashboard_app(get_store(), get_config())
     uvicorn.run(app, host=host, port=port)
 
 if __name__ == "__main__":
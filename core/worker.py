@@ -1,28 +1,119 @@
 # core/worker.py
+import errno
 import multiprocessing as mp
 import os
+import shlex
+import signal
+import sqlite3
 import subprocess
+import sys
+import threading
 import time
-from datetime import datetime
+from functools import lru_cache
 
-def utcnow() -> str:
-    return datetime.utcnow().isoformat() + "Z"
+from .config import ConfigStore
+from .db import JobStore, now_ms
 
-class WorkerProcess(mp.Process):
-    def __init__(self, name, store, config, stop_event):
+# Workers always start with spawn so they behave the same on every platform
+# and never inherit the parent's SQLite connections.
+MP = mp.get_context("spawn")
+
+# job_runs rows are buffered per worker and written in one transaction once
+# either limit is reached (and always on shutdown).
+RUN_FLUSH_SIZE = 50
+RUN_FLUSH_SECS = 1.0
+
+# Floor for the idle wait after a failed claim, so a job that NEXT_DUE_SQL
+# thinks is due but the claim can't take never turns the loop into a spin.
+MIN_WAIT_SECS = 0.05
+
+# WorkerManager housekeeping: bound the WAL and keep planner stats fresh.
+CHECKPOINT_SECS = 60
+OPTIMIZE_SECS = 600
+
+# Commands containing any of these need /bin/sh to interpret them.
+SHELL_CHARS = frozenset("|&;<>()$`\\*?[]{}~#=!\n")
+
+# Direct exec failures that sh handles itself: builtins and unknown programs
+# (ENOENT), non-executable files (EACCES/EPERM), scripts without a #! line
+# (ENOEXEC, which sh runs as a shell script).
+SHELL_FALLBACK_ERRNOS = frozenset({errno.ENOENT, errno.EACCES, errno.EPERM, errno.ENOEXEC})
+
+@lru_cache(maxsize=1024)
+def command_argv(cmd):
+    """argv to exec cmd directly, or None if it has to go through the shell.
+
+    cmd.exe builtins (echo, dir, ...) can't be told apart from programs, so
+    Windows always uses the shell.
+    """
+    if os.name == "nt" or any(ch in SHELL_CHARS for ch in cmd):
+        return None
+    try:
+        return tuple(shlex.split(cmd)) or None
+    except ValueError:
+        return None
+
+def run_command(cmd, timeout, stdout, stderr):
+    argv = command_argv(cmd)
+    if argv is not None:
+        try:
+            return subprocess.run(argv, stdout=stdout, stderr=stderr, timeout=timeout)
+        except OSError as e:
+            # Let sh retry these, so the outcome matches running cmd through it.
+            if e.errno not in SHELL_FALLBACK_ERRNOS:
+                raise
+    return subprocess.run(cmd, shell=True, stdout=stdout, stderr=stderr, timeout=timeout)
+
+class WorkerProcess(MP.Process):
+    def __init__(self, name, db_path, logs_dir, stop_event, wakeup):
         super().__init__()
         self.name = name
-        self.store = store
-        self.config = config
+        self.db_path = db_path
+        self.logs_dir = logs_dir
         self.stop_event = stop_event
+        self.wakeup = wakeup
+        self._run_buffer = []
+        self._last_flush = time.monotonic()
+
+    def flush_runs(self):
+        if self._run_buffer:
+            self.store.record_runs_batch(self._run_buffer)
+            self._run_buffer = []
+        self._last_flush = time.monotonic()
 
     def run(self):
-        poll_ms = int(self.config.get("poll_interval_ms") or 500)
-        default_timeout = int(self.config.get("default_timeout_secs") or 60)
+        # Exit through the finally below on SIGTERM (e.g. `timeout` signals the
+        # whole process group) so buffered job_runs are still written.
+        signal.signal(signal.SIGTERM, lambda _sig, _frm: sys.exit(0))
+        # Stores are opened here, in the child, once for the worker's lifetime.
+        self.store = JobStore(self.db_path, self.logs_dir)
+        self.config = ConfigStore(self.db_path)
+        try:
+            self._loop()
+        finally:
+            self.flush_runs()
+
+    def _wait_for_work(self, poll_secs):
+        # Sleep until the next scheduled job is due or an in-process enqueue
+        # releases the wakeup semaphore. Jobs enqueued from another process
+        # (the CLI) cannot, so never sleep longer than the poll interval.
+        due = self.store.next_due_in()
+        timeout = poll_secs if due is None else min(max(due, MIN_WAIT_SECS), poll_secs)
+        if not self.stop_event.is_set():
+            self.wakeup.acquire(timeout=timeout)
+
+    def _loop(self):
+        # Config is read once; changes take effect for newly started workers.
+        cfg = self.config.all()
+        poll_ms = int(cfg.get("poll_interval_ms") or 500)
+        default_timeout = int(cfg.get("default_timeout_secs") or 60)
+        backoff_base = int(cfg.get("backoff_base") or 2)
         while not self.stop_event.is_set():
+            if len(self._run_buffer) >= RUN_FLUSH_SIZE or time.monotonic() - self._last_flush >= RUN_FLUSH_SECS:
+                self.flush_runs()
             job = self.store.claim_next(self.name)
             if not job:
-                time.sleep(poll_ms / 1000.0)
+                self._wait_for_work(poll_ms / 1000.0)
                 continue
 
             job_id = job["id"]
@@ -30,67 +121,80 @@ class WorkerProcess(mp.Process):
             timeout = int(job.get("timeout_secs") or 0) or default_timeout
             stdout_path, stderr_path = self.store.log_paths_for(job_id)
 
-            started = utcnow()
+            started = now_ms()
             exit_code = None
-            bytes_out = 0
-            bytes_err = 0
-            try:
-            
-                with open(stdout_path, "ab") as out_f, open(stderr_path, "ab") as err_f:
-                    proc = subprocess.run(
-                        cmd,
-                        shell=True,              
-                        capture_output=True,     
-                        timeout=timeout
-                    )
-                    if proc.stdout:
-                        out_f.write(proc.stdout)
-                        bytes_out = len(proc.stdout)
-                    if proc.stderr:
-                        err_f.write(proc.stderr)
-                        bytes_err = len(proc.stderr)
+            # The child writes straight into the log files; sizes are measured
+            # from the file before and after instead of buffering the output.
+            with open(stdout_path, "ab") as out_f, open(stderr_path, "ab") as err_f:
+                out_start = os.fstat(out_f.fileno()).st_size
+                err_start = os.fstat(err_f.fileno()).st_size
+                try:
+                    proc = run_command(cmd, timeout, out_f, err_f)
                     exit_code = proc.returncode
-            except subprocess.TimeoutExpired as e:
-                with open(stderr_path, "ab") as err_f:
-                    msg = f"timeout after {timeout}s"
-                    err_f.write(msg.encode("utf-8") + b"\n")
-                    bytes_err = len(msg) + 1
-                exit_code = 124  
-            except Exception as e:
-                with open(stderr_path, "ab") as err_f:
-                    msg = f"exception: {e}"
-                    err_f.write(msg.encode("utf-8") + b"\n")
-                    bytes_err = len(msg) + 1
-                exit_code = 1
-
-            finished = utcnow()
-            self.store.record_run(job_id, started, finished, exit_code, bytes_out, bytes_err)
-
-            if exit_code == 0:
-                self.store.complete(job_id)
-            else:
-                row = self.store.increment_attempts(job_id)
-                base = int(self.config.get("backoff_base") or 2)
-                self.store.reschedule_or_dead(job_id, f"exit:{exit_code}", row["attempts"], row["max_retries"], base)
+                except subprocess.TimeoutExpired:
+                    err_f.write(f"timeout after {timeout}s\n".encode("utf-8"))
+                    exit_code = 124
+                except Exception as e:
+                    err_f.write(f"exception: {e}\n".encode("utf-8"))
+                    exit_code = 1
+                err_f.flush()
+                bytes_out = os.fstat(out_f.fileno()).st_size - out_start
+                bytes_err = os.fstat(err_f.fileno()).st_size - err_start
+
+            finished = now_ms()
+            self._run_buffer.append(self.store.run_row(job_id, started, finished, exit_code, bytes_out, bytes_err))
+
+            self.store.finalize_job(job_id, exit_code, f"exit:{exit_code}", backoff_base)
 
 class WorkerManager:
     def __init__(self, store, config):
         self.store = store
         self.config = config
         self.procs = []
-        self.stop_event = mp.Event()
+        self.housekeeper = None
+        self.stop_event = MP.Event()
+        # A semaphore rather than a Condition: release() never waits for the
+        # sleepers to acknowledge, so a worker that died while idle (SIGKILL,
+        # OOM) can't block the parent. Spare permits only cause an extra claim.
+        self.wakeup = MP.Semaphore(0)
+        store.on_enqueue = self.notify_new_job
+
+    def notify_new_job(self):
+        for _ in self.procs:
+            self.wakeup.release()
 
     def start(self, count=1):
         for i in range(count):
             name = f"worker-{i}-{os.getpid()}"
-            p = WorkerProcess(name, self.store, self.config, self.stop_event)
+            p = WorkerProcess(name, self.store.db_path, self.store.logs_dir, self.stop_event, self.wakeup)
             p.start()
             self.procs.append(p)
+        self.housekeeper = threading.Thread(target=self._housekeeping, name="queuectl-housekeeping", daemon=True)
+        self.housekeeper.start()
+
+    def _housekeeping(self):
+        last_optimize = time.monotonic()
+        while not self.stop_event.wait(CHECKPOINT_SECS):
+            try:
+                self.store.checkpoint()
+                if time.monotonic() - last_optimize >= OPTIMIZE_SECS:
+                    self.store.optimize()
+                    last_optimize = time.monotonic()
+            except sqlite3.OperationalError:
+                pass  # busy; try again next round
+        try:
+            self.store.optimize()
+        except sqlite3.OperationalError:
+            pass
 
     def stop(self):
         self.stop_event.set()
+        self.notify_new_job()  # wake idle workers now rather than after their poll
         for p in self.procs:
             p.join(timeout=10)
+        # Let the final optimize finish before the process exits.
+        if self.housekeeper is not None:
+            self.housekeeper.join(timeout=10)
 
     def is_running(self):
         return any(p.is_alive() for p in self.procs)
@@ -5,8 +5,15 @@ from pathlib import Path
 ROOT = Path(__file__).resolve().parent
 sys.path.insert(0, str(ROOT))
 
-from core.main import cli
+def cli_main(argv):
+    """Run one queuectl command in this process and return its exit code."""
+    from core.main import dispatch
+    return dispatch(argv)
+
 
 if __name__ == "__main__":
+    # Imported here, not at the top: spawned workers re-import this file as
+    # __mp_main__ and need none of the CLI.
+    from core.main import cli
     cli()
 
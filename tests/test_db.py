@@ -0,0 +1,32 @@
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from core import db
+
+
+class ClaimPlanTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.store = db.JobStore(str(Path(tmp.name) / "queuectl.db"), Path(tmp.name) / "logs")
+        self.addCleanup(lambda: self.store._conn().close())
+
+    def plan(self, sql):
+        args = [db.utcnow()] * sql.count("?")
+        return [row["detail"] for row in self.store._conn().execute("EXPLAIN QUERY PLAN " + sql, args)]
+
+    def test_claim_path_uses_partial_index(self):
+        for name in ("ANY_DUE_SQL", "CLAIM_SQL", "NEXT_DUE_SQL"):
+            with self.subTest(sql=name):
+                plan = self.plan(getattr(db, name))
+                self.assertTrue(any("idx_jobs_claim" in step for step in plan), plan)
+                self.assertFalse(any("idx_jobs_state" in step for step in plan), plan)
+                self.assertFalse(any("TEMP B-TREE" in step for step in plan), plan)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from core.worker import command_argv, run_command
+
+
+class CommandArgvTest(unittest.TestCase):
+    def setUp(self):
+        command_argv.cache_clear()
+
+    def test_table(self):
+        cases = [
+            ("echo hi", ("echo", "hi")),
+            ('echo "hello world"', ("echo", "hello world")),
+            ("echo 'a  b' c", ("echo", "a  b", "c")),
+            ("ls | wc -l", None),
+            ("true && false", None),
+            ("echo $HOME", None),
+            ("echo *.log", None),
+            ("FOO=1 env", None),
+            ("echo a > out.txt", None),
+            ("echo `date`", None),
+            ("echo hi # note", None),
+            ('echo "unterminated', None),
+            ("", None),
+            ("   ", None),
+        ]
+        for cmd, expected in cases:
+            with self.subTest(cmd=cmd):
+                self.assertEqual(command_argv(cmd), expected)
+
+    def test_windows_always_uses_shell(self):
+        with mock.patch("core.worker.os.name", "nt"):
+            self.assertIsNone(command_argv("echo hi"))
+
+
+@unittest.skipIf(os.name == "nt", "exit codes below are /bin/sh's")
+class RunCommandTest(unittest.TestCase):
+    def setUp(self):
+        command_argv.cache_clear()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = Path(tmp.name)
+        (self.tmp / "script.sh").write_text("echo from script\n")
+        (self.tmp / "noshebang").write_text("echo no shebang\nexit 5\n")
+        (self.tmp / "noshebang").chmod(0o755)
+
+    def run_cmd(self, cmd):
+        proc = run_command(cmd, 10, subprocess.PIPE, subprocess.PIPE)
+        return proc.returncode, proc.stdout.decode()
+
+    def test_table(self):
+        script = self.tmp / "script.sh"
+        cases = [
+            # (command, exit code, stdout)
+            ("echo hi", 0, "hi\n"),
+            ('echo "a  b"', 0, "a  b\n"),
+            ("echo a | tr a b", 0, "b\n"),
+            ("exit 3", 3, ""),                        # builtin: exec fails, sh runs it
+            ("cd /", 0, ""),
+            ("no-such-program-queuectl", 127, ""),
+            (str(self.tmp), 126, ""),                 # a directory
+            (str(script), 126, ""),                   # not executable
+            (f"sh {script}", 0, "from script\n"),
+            (str(self.tmp / "noshebang"), 5, "no shebang\n"),  # ENOEXEC: sh runs it
+        ]
+        for cmd, code, out in cases:
+            with self.subTest(cmd=cmd):
+                self.assertEqual(self.run_cmd(cmd), (code, out))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,83 +1,166 @@
 
+import argparse
+import contextlib
+import io
 import json
+import os
+import signal
 import subprocess
 import sys
 import time
 from pathlib import Path
 
+import queuectl
+
 ROOT = Path(__file__).resolve().parent
 PY = sys.executable
+QUEUECTL = str(ROOT / "queuectl.py")
 
-def run(cmd_list, check=True):
-    
-    cmd_str = " ".join(cmd_list)
-    print(f"\n> {cmd_str}")
-    result = subprocess.run(cmd_list, capture_output=True, text=True)
-    if check and result.returncode != 0:
-        print(f"ERROR: Command failed with exit code {result.returncode}")
-        print(f"STDOUT: {result.stdout}")
-        print(f"STDERR: {result.stderr}")
-        return False
-    print(result.stdout)
-    return True
+# States after which the worker step has nothing left to do for a job.
+TERMINAL_STATES = {"completed", "dead"}
+
+# Test payloads as minified JSON lines. Parsing them here validates them
+# once at import and yields the ids the checks wait on.
+JOB1 = '{"id":"val_test1","command":"echo Validation Test 1"}'
+JOB2 = '{"id":"val_test2","command":"cmd /c exit 1","max_retries":2}'
+JOBS_JSONL = JOB1 + "\n" + JOB2 + "\n"
+JOB_IDS = [json.loads(job)["id"] for job in (JOB1, JOB2)]
+COUNT_KEYS = ["pending", "processing", "completed", "failed", "dead", "total_runs"]
+
+# Echo each command and its output; --quiet keeps only headings and failures.
+VERBOSE = True
+
+def run_inprocess(args, input=None):
+    # queuectl commands are dispatched in this interpreter instead of paying
+    # a fresh Python start-up and import per test. A quiet caller simply
+    # drops the buffers.
+    out, err = io.StringIO(), io.StringIO()
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+        stdin, sys.stdin = sys.stdin, io.StringIO(input or "")
+        try:
+            returncode = queuectl.cli_main(args)
+        finally:
+            sys.stdin = stdin
+    return returncode, out.getvalue(), err.getvalue()
+
+def run(title, args, input=None, quiet=False):
+    """Run one queuectl command as a test step and print its report in one write.
+
+    quiet steps only report their exit status; their output is shown only if they fail.
+    """
+    buf = io.StringIO()
+    buf.write(f"\n{title}\n")
+    if VERBOSE:
+        buf.write(f"\n> queuectl {' '.join(args)}\n")
+    returncode, stdout, stderr = run_inprocess(args, input)
+    ok = returncode == 0
+    if not ok:
+        buf.write(f"ERROR: Command failed with exit code {returncode}\n")
+        buf.write(f"STDOUT: {stdout}\n")
+        buf.write(f"STDERR: {stderr}\n")
+    elif VERBOSE:
+        buf.write((f"(exit {returncode})" if quiet else stdout) + "\n")
+    sys.stdout.write(buf.getvalue())
+    sys.stdout.flush()
+    return ok
+
+def query(*specs):
+    """Answer several read-only queries with one `query --multi` call."""
+    returncode, out, err = run_inprocess(["query", "--multi", json.dumps(specs)])
+    if returncode != 0:
+        sys.exit(f"ERROR: query failed with exit code {returncode}\n{err}")
+    return json.loads(out)
+
+def status_snapshot(job_ids):
+    """The state counts plus each given job's state."""
+    return query({"op": "status", "jobs": job_ids})[0]
+
+def wait_for_jobs(job_ids, timeout=10.0):
+    """Poll job states until all are terminal; False if timeout runs out first."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if all(state in TERMINAL_STATES for state in status_snapshot(job_ids)["jobs"].values()):
+            return True
+        time.sleep(0.05)
+    return False
+
+def stop_worker(proc, grace=0.5):
+    """SIGTERM `worker start`, give it `grace` seconds to shut down cleanly,
+    then kill its whole process group. Returns the worker's stderr."""
+    proc.terminate()
+    try:
+        _, err = proc.communicate(timeout=grace)
+    except subprocess.TimeoutExpired:
+        # Killing just the parent would orphan its spawned workers, which
+        # keep the stderr pipe open until their current job ends.
+        if hasattr(os, "killpg"):
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+        _, err = proc.communicate(timeout=5)
+    return err.decode(errors="replace")
+
+def main(argv=None):
+    global VERBOSE
+    parser = argparse.ArgumentParser(description="End-to-end validation of the queuectl CLI")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only print test headings and failures")
+    VERBOSE = not parser.parse_args(argv).quiet
+    # Block-buffer stdout even on a terminal; each test block flushes once.
+    sys.stdout.reconfigure(line_buffering=False, write_through=False)
 
-def main():
     print("=" * 60)
     print("QueueCTL Validation Script")
     print("=" * 60)
-    
-    
-    print("\n[Test 1] Enqueue successful job")
-    job1 = json.dumps({"id": "val_test1", "command": "echo Validation Test 1"})
-    if not run([PY, "queuectl.py", "enqueue", job1]):
+
+    # Both jobs go in with one enqueue-file call, i.e. one transaction.
+    if not run("[Test 1+2] Enqueue successful and failing (will retry) jobs",
+               ["enqueue-file", "-"], input=JOBS_JSONL):
         return False
-    
-        print("\n[Test 2] Enqueue failing job (will retry)")
-    job2 = json.dumps({"id": "val_test2", "command": "cmd /c exit 1", "max_retries": 2})
-    if not run([PY, "queuectl.py", "enqueue", job2]):
+    if not run("[Test 5] Test configuration", ["config", "set", "test_key", "test_value"], quiet=True):
         return False
-    
+
+    # Tests 3 and 4 share one read-only query.
+    before, pending = query({"op": "status", "jobs": JOB_IDS}, {"op": "list", "state": "pending"})
     print("\n[Test 3] Check status")
-    if not run([PY, "queuectl.py", "status"]):
-        return False
-    
+    if VERBOSE:
+        print(json.dumps(before))
+
     print("\n[Test 4] List pending jobs")
-    if not run([PY, "queuectl.py", "list", "--state", "pending"]):
-        return False
-    
-    
-    print("\n[Test 5] Test configuration")
-    if not run([PY, "queuectl.py", "config", "set", "test_key", "test_value"]):
-        return False
-    if not run([PY, "queuectl.py", "config", "get", "test_key"]):
+    print(", ".join(job["id"] for job in pending) or "none")
+
+    if not run("[Test 5] Read configuration back", ["config", "get", "test_key"]):
         return False
-    
-    
-    print("\n[Test 6] Start workers for 5 seconds")
-    proc = subprocess.Popen([PY, "queuectl.py", "worker", "start", "--count", "1"])
-    time.sleep(5)
-    proc.terminate()
-    proc.wait(timeout=5)
-    
-    
+
+    print("\n[Test 6] Start workers until both jobs finish (10s max)")
+    sys.stdout.flush()
+    # Only stderr is kept so a crashing worker can be reported; its progress
+    # chatter goes to DEVNULL. Its own session lets stop_worker kill the
+    # spawned workers along with it.
+    proc = subprocess.Popen([PY, QUEUECTL, "worker", "start", "--count", "1"],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, start_new_session=True)
+    if not wait_for_jobs(JOB_IDS):
+        print("WARNING: jobs still running after 10s")
+    worker_err = stop_worker(proc)
+    if worker_err:
+        print(f"Worker stderr:\n{worker_err}")
+
+    # Tests 7-9 share one read-only query; 7 is diffed against Test 3's counts.
+    after, dead = query({"op": "status", "jobs": JOB_IDS}, {"op": "dlq_list"})
     print("\n[Test 7] Check status after processing")
-    if not run([PY, "queuectl.py", "status"]):
-        return False
-    
+    print(", ".join(f"{key}: {after[key]} ({after[key] - before[key]:+d})" for key in COUNT_KEYS))
+
     print("\n[Test 8] List completed jobs")
-    if not run([PY, "queuectl.py", "list", "--state", "completed"], check=False):
-        pass  
-    
-        print("\n[Test 9] Check DLQ")
-    if not run([PY, "queuectl.py", "dlq", "list"], check=False):
-        pass  
-    
+    print(", ".join(job_id for job_id, state in after["jobs"].items() if state == "completed") or "none")
+
+    print("\n[Test 9] Check DLQ")
+    print(", ".join(job["id"] for job in dead) or "none")
+
     print("\n" + "=" * 60)
     print("Validation complete!")
     print("=" * 60)
+    sys.stdout.flush()
     return True
 
 if __name__ == "__main__":
     success = main()
     sys.exit(0 if success else 1)
-